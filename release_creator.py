@@ -1,14 +1,53 @@
 import argparse
+import atexit
+import hashlib
+import json
+import os
 import requests
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase
+from urllib3.util import Retry
+
+try:
+    from orjson import dumps as jsonDumps, loads as jsonLoads
+except ImportError:
+    jsonLoads = json.loads
+
+    def jsonDumps(obj):
+        return json.dumps(obj).encode()
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+JSON_HEADERS = {'Content-Type': 'application/json'}
+# (connect, read) timeout in seconds for every HTTP call
+REQUEST_TIMEOUT = (3.05, 10)
+# Seconds a cached tag is trusted without asking GitHub again
+TAG_CACHE_TTL = 3600
+
+TAG_VERSION_PATTERN = re.compile(r'\d{4}\.\d{2}(?:\.\d+)?')
+# https://stackoverflow.com/questions/59081778/rules-for-special-characters-in-github-repository-name#59082561
+OWNER_REPO_PATTERN = re.compile(r'[\w.-]+/[\w.-]+')
+# https://gist.github.com/magnetikonline/073afe7909ffdd6f10ef06a00bc3bc88
+TOKEN_PATTERN = re.compile(
+    r'ghp_[a-zA-Z0-9]{36}|github_pat_[a-zA-Z0-9]{22}_[a-zA-Z0-9]{59}|v[0-9]\.[0-9a-f]{40}')
 
 
 def argParser():
     parser = argparse.ArgumentParser(description='Compare latest tags of two repos')
-    parser.add_argument('--auth', type=str, help='Github authentication token', required=True)
+    parser.add_argument('--auth', type=str, help='Github authentication token(s), comma separated', required=True)
     parser.add_argument('--target_owner_repo', type=str, help='Target owner/repo', required=True)
     parser.add_argument('--local_owner_repo', type=str, help='Local owner/repo', required=True)
     parser.add_argument('--discord_webhook', type=str, help='Discord webhook', default=None, required=False)
+    parser.add_argument('--cache_file', type=str, help='ETag cache file',
+                        default=os.path.expanduser('~/.cache/yapdd/etags.json'), required=False)
     return parser.parse_args()
 
 
@@ -16,30 +55,259 @@ def getLatestTag(jsonResponse):
     return jsonResponse[-1]['ref'].split('/')[-1]
 
 
-def getReleases(url, owner_repo, headers):
-    return requests.get(f'{url.prefix}/{owner_repo}/{url.postfix}', headers=headers)
+def getReleaseTag(jsonResponse):
+    return jsonResponse['tag_name']
+
+
+# Streams the tag list when ijson is available so only the last ref is kept in memory,
+# returns None when the repo has no tags
+def readLatestTag(response):
+    if ijson is None:
+        refs = jsonLoads(response.content)
+        return getLatestTag(refs) if refs else None
+
+    response.raw.decode_content = True
+    ref = None
+    for ref in ijson.items(response.raw, 'item.ref'):
+        pass
+    return ref.split('/')[-1] if ref else None
+
+
+def readReleaseTag(response):
+    return getReleaseTag(jsonLoads(response.content))
+
+
+def tokenId(token):
+    return hashlib.sha256(token.encode()).hexdigest()[:16]
+
+
+# Rotates through several tokens, skipping any that hit their rate limit until it resets.
+# The rotation offset and cool-off times live in state, which is persisted in the cache file.
+class TokenPool(AuthBase):
+    def __init__(self, tokens, state):
+        self._tokens = tokens
+        self._state = state
+        self._state.setdefault('offset', 0)
+        self._state.setdefault('coolingOff', {})
+        self._lock = threading.Lock()
+
+    def _resetAt(self, token):
+        return self._state['coolingOff'].get(tokenId(token), 0)
+
+    def availableToken(self):
+        with self._lock:
+            now = time.time()
+            for _ in range(len(self._tokens)):
+                token = self._tokens[self._state['offset'] % len(self._tokens)]
+                self._state['offset'] = (self._state['offset'] + 1) % len(self._tokens)
+                if self._resetAt(token) <= now:
+                    return token
+            return None
 
+    def nextToken(self):
+        return self.availableToken() or min(self._tokens, key=self._resetAt)
 
-def createRelease(url, owner_repo, headers, tag_name, name, body, target_commitish='main'):
+    # Same resend pattern as requests' HTTPDigestAuth.handle_401
+    def checkRateLimit(self, r, **kwargs):
+        if r.status_code not in (403, 429) or r.headers.get('X-RateLimit-Remaining') != '0':
+            return r
+
+        token = r.request.headers['Authorization'][len('Bearer '):]
+        with self._lock:
+            self._state['coolingOff'][tokenId(token)] = int(r.headers.get('X-RateLimit-Reset', 0))
+
+        token = self.availableToken()
+        if token is None:
+            return r
+
+        r.content
+        r.close()
+        prep = r.request.copy()
+        prep.headers['Authorization'] = f'Bearer {token}'
+        _r = r.connection.send(prep, **kwargs)
+        _r.history.append(r)
+        _r.request = prep
+        return self.checkRateLimit(_r, **kwargs)
+
+    def __call__(self, r):
+        r.headers['Authorization'] = f'Bearer {self.nextToken()}'
+        return r
+
+
+def createSession(headers, tokenPool):
+    session = requests.Session()
+    session.headers.update(headers)
+    session.auth = tokenPool
+    session.hooks['response'].append(tokenPool.checkRateLimit)
+    # Only GETs are retried, a retried POST could create a duplicate release
+    retries = Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504],
+                    allowed_methods=frozenset(['GET']))
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=retries))
+    return session
+
+
+def loadTagCache(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def saveTagCache(path, cache):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(cache, f)
+
+
+def cachedTag(cache, owner_repo, maxAge=TAG_CACHE_TTL):
+    cached = cache.get(owner_repo)
+    if cached and time.time() - cached.get('checked', 0) < maxAge:
+        return cached['tag']
+    return None
+
+
+def getReleases(url, owner_repo, session, headers=None, stream=False):
+    return session.get(f'{url.prefix}/{owner_repo}/{url.postfix}', headers=headers, stream=stream,
+                       timeout=REQUEST_TIMEOUT)
+
+
+def getLatestRelease(url, owner_repo, session, headers=None):
+    return session.get(f'{url.prefix}/{owner_repo}/{url.latest_release}', headers=headers,
+                       timeout=REQUEST_TIMEOUT)
+
+
+# https://docs.github.com/en/rest/using-the-rest-api/best-practices-for-using-the-rest-api#use-conditional-requests-if-appropriate
+def fetchLatestTag(url, owner_repo, session, cache, webhook=None):
+    headers = {}
+    cached = cache.get(owner_repo)
+    if cached and cached.get('etag'):
+        headers['If-None-Match'] = cached['etag']
+
+    try:
+        r = getLatestRelease(url, owner_repo, session, headers)
+        if r.status_code == 404:
+            # No published releases, fall back to the full tag list
+            r = getReleases(url, owner_repo, session, headers, stream=ijson is not None)
+            readTag = readLatestTag
+        else:
+            readTag = readReleaseTag
+    except requests.RequestException as e:
+        notify(f'Fetching latest tag for {owner_repo} failed\n\tError: {e}', raiseException=True, webhook=webhook)
+
+    if r.status_code == 304:
+        r.close()
+        cached['checked'] = time.time()
+        return cached['tag']
+
+    if not r.ok:
+        text = r.text
+        r.close()
+        notify(
+            f'Fetching latest tag for {owner_repo} failed\n\tStatus code: {r.status_code}\n\tText: {text}',
+            raiseException=True, webhook=webhook)
+
+    tag = readTag(r)
+    if tag is None:
+        notify(f'No tags found for {owner_repo}', raiseException=True, webhook=webhook)
+    cache[owner_repo] = {'etag': r.headers.get('ETag'), 'tag': tag, 'checked': time.time()}
+    return tag
+
+
+# Same choice as the REST path, latest release first, otherwise the last tag by name
+def getGraphQLTag(repo):
+    if repo['latestRelease']:
+        return repo['latestRelease']['tagName']
+    return repo['refs']['nodes'][0]['name']
+
+
+LATEST_TAGS_QUERY = '''
+query($targetOwner: String!, $targetName: String!, $localOwner: String!, $localName: String!) {
+  target: repository(owner: $targetOwner, name: $targetName) {
+    latestRelease { tagName }
+    refs(refPrefix: "refs/tags/", last: 1, orderBy: {field: ALPHABETICAL, direction: ASC}) { nodes { name } }
+  }
+  local: repository(owner: $localOwner, name: $localName) {
+    latestRelease { tagName }
+    refs(refPrefix: "refs/tags/", last: 1, orderBy: {field: ALPHABETICAL, direction: ASC}) { nodes { name } }
+  }
+}
+'''
+
+
+# Fetches both latest tags in a single request, returns None if either can't be resolved
+def getLatestTagsGraphQL(url, session, target_owner_repo, local_owner_repo):
+    targetOwner, targetName = target_owner_repo.split('/')
+    localOwner, localName = local_owner_repo.split('/')
+    data = {
+        'query': LATEST_TAGS_QUERY,
+        'variables': {
+            'targetOwner': targetOwner,
+            'targetName': targetName,
+            'localOwner': localOwner,
+            'localName': localName,
+        },
+    }
+    try:
+        r = session.post(url.graphql, data=jsonDumps(data), headers=JSON_HEADERS, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException:
+        return None
+    if r.status_code != 200:
+        return None
+
+    try:
+        repos = jsonLoads(r.content)['data']
+        return tuple(getGraphQLTag(repos[alias]) for alias in ('target', 'local'))
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
+
+
+def createRelease(url, owner_repo, session, tag_name, name, body, target_commitish='main'):
     data = {
         'tag_name': tag_name,
         'name': name,
         'body': body,
         'target_commitish': target_commitish,
     }
-    return requests.post(f'{url.prefix}/{owner_repo}/releases', json=data, headers=headers)
+    return session.post(f'{url.prefix}/{owner_repo}/releases', data=jsonDumps(data), headers=JSON_HEADERS,
+                        timeout=REQUEST_TIMEOUT, allow_redirects=False)
 
 
 def sendDiscordNotification(message, webhook):
     data = {
         'content': message,
     }
-    return requests.post(webhook, json=data)
+    return requests.post(webhook, data=jsonDumps(data), headers=JSON_HEADERS, timeout=REQUEST_TIMEOUT)
+
 
+# Sends notifications in the background, one at a time so they arrive in order
+class Notifier:
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._futures = []
 
-def notify(message, raiseException=False, webhook=None):
+    def submit(self, message, webhook):
+        self._futures.append(self._executor.submit(sendDiscordNotification, message, webhook))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self._executor.shutdown(wait=True)
+        for future in self._futures:
+            if future.exception() is None:
+                continue
+            if excType is None:
+                raise future.exception()
+            print(f'Discord notification failed: {future.exception()}')
+
+
+def notify(message, raiseException=False, webhook=None, notifier=None):
     if webhook:
-        sendDiscordNotification(message, webhook)
+        if notifier:
+            notifier.submit(message, webhook)
+        else:
+            sendDiscordNotification(message, webhook)
 
     if raiseException:
         raise Exception(message)
@@ -51,23 +319,37 @@ def compareTags(a, b):
     return True if a == b else False
 
 
+# Plain string check for the common YYYY.MM[.P[P]] shapes, avoids running the regex
+def fastTagSanityCheck(version):
+    if len(version) not in (7, 9, 10) or version[4] != '.' or version[7:8] not in ('', '.'):
+        return False
+    digits = version[:4] + version[5:7] + version[8:]
+    return digits.isascii() and digits.isdigit()
+
+
+@lru_cache(maxsize=128)
 def tagSanityCheck(version):
-    return True if re.match(r'^\d{4}\.\d{2}(\.\d{0,2})?', version) else False
+    return fastTagSanityCheck(version) or TAG_VERSION_PATTERN.fullmatch(version) is not None
 
 
-# https://stackoverflow.com/questions/59081778/rules-for-special-characters-in-github-repository-name#59082561
+@lru_cache(maxsize=128)
 def ownerRepoSanityCheck(owner_repo):
-    return True if re.match(r'^[\w.-]+\/[\w.-]+$', owner_repo) else False
+    return OWNER_REPO_PATTERN.fullmatch(owner_repo) is not None
 
 
-# https://gist.github.com/magnetikonline/073afe7909ffdd6f10ef06a00bc3bc88
+@lru_cache(maxsize=128)
 def tokenSanityCheck(token):
-    pat = r'^(ghp_[a-zA-Z0-9]{36}|github_pat_[a-zA-Z0-9]{22}_[a-zA-Z0-9]{59}|v[0-9]\.[0-9a-f]{40})$'
-    return True if re.match(pat, token) else False
+    return TOKEN_PATTERN.fullmatch(token) is not None
+
+
+# Empty entries are dropped so an unset optional secret doesn't break --auth
+def splitTokens(auth):
+    return [token for token in auth.split(',') if token]
 
 
 def SanityCheck(auth, target_owner_repo, local_owner_repo, webhook=None):
-    if not tokenSanityCheck(auth):
+    tokens = splitTokens(auth)
+    if not tokens or not all(tokenSanityCheck(token) for token in tokens):
         notify('Auth token is not valid', raiseException=True, webhook=webhook)
 
     if not ownerRepoSanityCheck(target_owner_repo):
@@ -82,46 +364,77 @@ def main():
 
     SanityCheck(args.auth, args.target_owner_repo, args.local_owner_repo, args.discord_webhook)
 
-    AUTH_BEARER = args.auth
+    cache = loadTagCache(args.cache_file)
+    atexit.register(saveTagCache, args.cache_file, cache)
+
+    TOKEN_POOL = TokenPool(splitTokens(args.auth), cache.setdefault('tokenPool', {}))
 
     HEADERS = {
         'Accept': 'application/vnd.github+json',
-        'Authorization': f'Bearer {AUTH_BEARER}',
         'X-GitHub-Api-Version': '2022-11-28',
     }
 
     URL = type('URL', (object,), {})
     setattr(URL, 'prefix', 'https://api.github.com/repos')
     setattr(URL, 'postfix', 'git/matching-refs/tags')
-
-    latestTargetTag = getLatestTag(getReleases(URL, args.target_owner_repo, HEADERS).json())
-    if not tagSanityCheck(latestTargetTag):
-        notify(f'Latest tag in target repo is not valid: {latestTargetTag}',
-               raiseException=True, webhook=args.discord_webhook)
-
-    latestLocalTag = getLatestTag(getReleases(URL, args.local_owner_repo, HEADERS).json())
-    if not tagSanityCheck(latestLocalTag):
-        notify(f'Latest tag in local repo is not valid: {latestLocalTag}',
-               raiseException=True, webhook=args.discord_webhook)
-
-    if compareTags(latestTargetTag, latestLocalTag):
-        notify('No update needed')
-    else:
-        notify(f'Update needed, latest is {latestTargetTag}', webhook=args.discord_webhook)
-        r = createRelease(
-            URL,
-            args.local_owner_repo,
-            HEADERS,
-            latestTargetTag,
-            latestTargetTag,
-            f'This release was automatically generated, changes for pi-hole are available here: https://github.com/pi-hole/docker-pi-hole/releases/tag/{latestTargetTag}')
-
-        if r.status_code == 201:
-            notify('Release created', webhook=args.discord_webhook)
+    setattr(URL, 'latest_release', 'releases/latest')
+    setattr(URL, 'graphql', 'https://api.github.com/graphql')
+
+    with createSession(HEADERS, TOKEN_POOL) as session, ThreadPoolExecutor(max_workers=2) as executor, \
+            Notifier() as notifier:
+        latestTags = getLatestTagsGraphQL(URL, session, args.target_owner_repo, args.local_owner_repo)
+        if latestTags:
+            latestTargetTag, latestLocalTag = latestTags
+        else:
+            freshLocalTag = cachedTag(cache, args.local_owner_repo)
+            targetFuture = executor.submit(fetchLatestTag, URL, args.target_owner_repo, session, cache,
+                                           args.discord_webhook)
+
+            # Local only changes when a release is created, only look it up if the target moved
+            if freshLocalTag:
+                latestTargetTag = targetFuture.result()
+                if latestTargetTag == freshLocalTag:
+                    latestLocalTag = freshLocalTag
+                else:
+                    latestLocalTag = fetchLatestTag(URL, args.local_owner_repo, session, cache, args.discord_webhook)
+            else:
+                localFuture = executor.submit(fetchLatestTag, URL, args.local_owner_repo, session, cache,
+                                              args.discord_webhook)
+                latestTargetTag = targetFuture.result()
+                latestLocalTag = localFuture.result()
+
+        if not tagSanityCheck(latestTargetTag):
+            notify(f'Latest tag in target repo is not valid: {latestTargetTag}',
+                   raiseException=True, webhook=args.discord_webhook, notifier=notifier)
+
+        if not tagSanityCheck(latestLocalTag):
+            notify(f'Latest tag in local repo is not valid: {latestLocalTag}',
+                   raiseException=True, webhook=args.discord_webhook, notifier=notifier)
+
+        if compareTags(latestTargetTag, latestLocalTag):
+            notify('No update needed')
         else:
-            notify(
-                f'Release creation failed\n\tStatus code: {r.status_code}\n\tText: {r.text}',
-                webhook=args.discord_webhook)
+            notify(f'Update needed, latest is {latestTargetTag}', webhook=args.discord_webhook, notifier=notifier)
+            try:
+                r = createRelease(
+                    URL,
+                    args.local_owner_repo,
+                    session,
+                    latestTargetTag,
+                    latestTargetTag,
+                    f'This release was automatically generated, changes for pi-hole are available here: https://github.com/pi-hole/docker-pi-hole/releases/tag/{latestTargetTag}')
+                failure = None if r.status_code == 201 else f'Status code: {r.status_code}\n\tText: {r.text}'
+            except requests.RequestException as e:
+                # On a read timeout the release may still have been created
+                failure = f'Error: {e}'
+
+            if failure is None:
+                cache[args.local_owner_repo] = {'etag': None, 'tag': latestTargetTag, 'checked': time.time()}
+                notify('Release created', webhook=args.discord_webhook, notifier=notifier)
+            else:
+                notify(
+                    f'Release creation failed\n\t{failure}',
+                    webhook=args.discord_webhook, notifier=notifier)
 
 
 if __name__ == '__main__':